@@ -1,12 +1,11 @@
 import asyncio
-import json
 
 import logging
 import re
 
-from openai import OpenAI, OpenAIError, BadRequestError
-
-from openai.types.beta.threads.run_submit_tool_outputs_params import ToolOutput
+import backoff
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI, OpenAIError, BadRequestError, APIConnectionError, APIStatusError
 
 import os
 from dotenv import load_dotenv
@@ -16,10 +15,26 @@ load_dotenv()
 OPENAI_KEY = os.getenv("OPENAI_KEY")
 ASSISTANT_ID = os.getenv("ASSISTANT_ID")
 
-client = OpenAI(api_key=OPENAI_KEY)
+# Retries are done with backoff below, so the SDK's own retry loop is off.
+client = AsyncOpenAI(api_key=OPENAI_KEY, max_retries=0)
+
+LIMITER = AsyncLimiter(max_rate=50, time_period=1)
+_RETRYABLE_ERRORS = (APIConnectionError, APIStatusError)
+
+_CITATION_RE = re.compile(r'【[^】]+】')
+
+def _is_permanent(e):
+    # Mirrors the SDK: connection errors, timeouts, 408, 409, 429 and 5xx are retried.
+    return isinstance(e, APIStatusError) and e.status_code not in (408, 409, 429) and e.status_code < 500
+
+@backoff.on_exception(backoff.expo, _RETRYABLE_ERRORS, max_time=30, giveup=_is_permanent)
+async def _call(method, **kwargs):
+    async with LIMITER:
+        return await method(**kwargs)
 
 async def create_thread(question):
-    thread = client.beta.threads.create(
+    thread = await _call(
+        client.beta.threads.create,
         messages=[
             {
                 "role": "user",
@@ -29,31 +44,38 @@ async def create_thread(question):
     )
     return thread.id
 
+_ACTIVE_RUN_STATUSES = {"queued", "in_progress", "cancelling"}
+
+async def wait_until_idle(thread_id, initial=0.1, factor=1.5, cap=2.0):
+    runs = await _call(client.beta.threads.runs.list, thread_id=thread_id, limit=20)
+    active_runs = [run for run in runs.data if run.status in _ACTIVE_RUN_STATUSES]
+    if not active_runs:
+        return
+
+    logging.info("Активный процесс найден, ожидание завершения...")
+    delay = initial
+    pending = [run.id for run in active_runs]
+    while pending:
+        await asyncio.sleep(delay)
+        delay = min(cap, delay * factor)
+        still_active = []
+        for run_id in pending:
+            run = await _call(client.beta.threads.runs.retrieve, thread_id=thread_id, run_id=run_id)
+            if run.status in _ACTIVE_RUN_STATUSES:
+                still_active.append(run_id)
+        pending = still_active
+
 async def add_user_message(thread_id, user_message):
     max_attempts = 5
     attempt = 0
 
-    async def check_active_runs(thread_id):
-        while True:
-            runs = client.beta.threads.runs.list(thread_id=thread_id)
-            active_runs = [run for run in runs if run.status == 'in_progress']
-            if not active_runs:
-                return True
-            logging.info("Ожидание завершения всех активных процессов...")
-            await asyncio.sleep(1)
-
     try:
-        while True:
-            runs = client.beta.threads.runs.list(thread_id=thread_id)
-            active_runs = [run for run in runs if run.status == 'in_progress']
-            if not active_runs:
-                break
-            logging.info("Активный процесс найден, ожидание завершения...")
-            await asyncio.sleep(1)
+        await wait_until_idle(thread_id)
 
         while attempt < max_attempts:
             try:
-                client.beta.threads.messages.create(
+                await _call(
+                    client.beta.threads.messages.create,
                     thread_id=thread_id,
                     role="user",
                     content=user_message
@@ -71,34 +93,28 @@ async def add_user_message(thread_id, user_message):
 
         if attempt >= max_attempts:
             logging.warning("Достигнут лимит попыток, завершаем активный процесс.")
-            tool_outputs = []
-            for run in active_runs:
-                tool_outputs.append(ToolOutput(
-                    tool_call_id=run.id,
-                    output=json.dumps({"result": "success"})
-                ))
+            runs = await _call(client.beta.threads.runs.list, thread_id=thread_id, limit=20)
+            stuck_runs = [run for run in runs.data if run.status in {"queued", "in_progress", "requires_action"}]
+            for run in stuck_runs:
                 try:
-                    client.beta.threads.runs.submit_tool_outputs(
-                        thread_id=thread_id,
-                        run_id=run.id,
-                        tool_outputs=tool_outputs
-                    )
-                    logging.info(f"Процесс {run.id} успешно завершен.")
+                    await _call(client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run.id)
+                    logging.info(f"Процесс {run.id} отменен.")
                 except BadRequestError as e:
                     logging.error(f"Ошибка при завершении процесса {run.id}: {e}")
                     raise
 
-            if await check_active_runs(thread_id):
-                try:
-                    client.beta.threads.messages.create(
-                        thread_id=thread_id,
-                        role="user",
-                        content=user_message
-                    )
-                    logging.info("Сообщение успешно отправлено после завершения активного процесса.")
-                except BadRequestError as e:
-                    logging.error(f"Ошибка при повторной отправке сообщения в поток: {e}")
-                    raise
+            await wait_until_idle(thread_id)
+            try:
+                await _call(
+                    client.beta.threads.messages.create,
+                    thread_id=thread_id,
+                    role="user",
+                    content=user_message
+                )
+                logging.info("Сообщение успешно отправлено после завершения активного процесса.")
+            except BadRequestError as e:
+                logging.error(f"Ошибка при повторной отправке сообщения в поток: {e}")
+                raise
     except OpenAIError as e:
         logging.error(f"Ошибка OpenAI: {e}")
         raise
@@ -106,24 +122,35 @@ async def add_user_message(thread_id, user_message):
         logging.error(f"Неожиданная ошибка: {e}")
         raise
 
-async def create_run(thread_id):
-    try:
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id, assistant_id=ASSISTANT_ID, tool_choice={"type": "file_search"},
-        )
+async def create_run(thread_id, on_delta=None):
+    chunks = []
 
-        messages_page = client.beta.threads.messages.list(
-            thread_id=thread_id, run_id=run.id
-        )
+    async def wait_for_failed_run(details):
+        await wait_until_idle(thread_id)
 
-        response_text = ""
+    # Only retry until the first delta is forwarded; later retries would replay text.
+    @backoff.on_exception(
+        backoff.expo, _RETRYABLE_ERRORS, max_time=30,
+        giveup=lambda e: bool(chunks) or _is_permanent(e),
+        on_backoff=wait_for_failed_run,
+    )
+    async def stream_reply():
+        async with LIMITER:
+            async with client.beta.threads.runs.stream(
+                thread_id=thread_id, assistant_id=ASSISTANT_ID, tool_choice={"type": "file_search"},
+            ) as stream:
+                async for delta in stream.text_deltas:
+                    chunks.append(delta)
+                    if on_delta is not None:
+                        await on_delta(delta)
+
+    try:
+        await stream_reply()
 
-        messages_list = [await message_to_dict(message) for message in messages_page]
-        for message in messages_list:
-            response_text = message['content'][0]['text']
-            logging.info(f"Assistant response: {response_text}")
+        response_text = "".join(chunks)
+        logging.info(f"Assistant response: {response_text}")
 
-        text = await remove_square_brackets(response_text)
+        text = remove_square_brackets(response_text)
 
         return text
 
@@ -131,24 +158,5 @@ async def create_run(thread_id):
         logging.error(f"An error occurred: {e}")
         raise
 
-async def remove_square_brackets(content):
-    cleaned_content = re.sub(r'【[^】]+】', '', content)
-    return cleaned_content
-
-
-async def message_to_dict(message):
-    return {
-        'id': message.id,
-        'assistant_id': message.assistant_id,
-        'completed_at': message.completed_at,
-        'content': [{'text': content_block.text.value, 'type': content_block.type} for content_block in
-                    message.content],
-        'created_at': message.created_at,
-        'incomplete_at': message.incomplete_at,
-        'metadata': message.metadata,
-        'object': message.object,
-        'role': message.role,
-        'run_id': message.run_id,
-        'status': message.status,
-        'thread_id': message.thread_id
-    }
\ No newline at end of file
+def remove_square_brackets(content: str) -> str:
+    return _CITATION_RE.sub('', content)
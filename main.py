@@ -1,16 +1,20 @@
 import asyncio
 import logging
 import os
-import json
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from typing import Optional
 
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, select
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, cast, func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 from ai_handler import create_thread, create_run, add_user_message
 
@@ -30,7 +34,16 @@ ASSISTANT_ID = os.getenv("ASSISTANT_ID")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL is not set!")
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Async engines need AsyncAdaptedQueuePool; the plain QueuePool is not asyncio-safe.
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=os.getenv("DEBUG", "").lower() in ("1", "true", "yes"),
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "40")),
+    pool_pre_ping=True,
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+)
 Base = declarative_base()
 async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
@@ -51,6 +64,8 @@ class Thread(Base):
     messages = relationship("Message", back_populates="thread", cascade="all, delete")
     user = relationship("User", back_populates="threads")
 
+    __table_args__ = (Index("ix_thread_user_created", "user_id", created_at.desc()),)
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
@@ -60,6 +75,8 @@ class Message(Base):
     timestamp = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(hours=1))
     thread = relationship("Thread", back_populates="messages")
 
+    __table_args__ = (Index("ix_msg_thread_ts", "thread_id", "timestamp"),)
+
 class OpenAIThread(Base):
     __tablename__ = "openai_threads"
 
@@ -70,6 +87,7 @@ class OpenAIThread(Base):
 
     user = relationship("User", back_populates="openai_thread")
 
+# Serve with `uvicorn main:app --loop uvloop` (see Dockerfile); all I/O here benefits from uvloop.
 app = FastAPI()
 
 app.add_middleware(
@@ -86,30 +104,87 @@ async def get_db():
 
 @app.on_event("startup")
 async def on_startup():
+    if os.getenv("AUTO_CREATE_SCHEMA") != "1":
+        logger.info("AUTO_CREATE_SCHEMA is not set, skipping schema creation.")
+        return
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     logger.info("Database initialized (if not existed).")
 
+@dataclass(slots=True)
+class InboundMessage:
+    message: str = ""
+    @classmethod
+    def parse(cls, data: str) -> "InboundMessage":
+        payload = orjson.loads(data)
+        if not isinstance(payload, dict):
+            raise ValueError("payload must be a JSON object")
+        message = payload.get("message", "")
+        if not isinstance(message, str):
+            raise ValueError("message must be a string")
+        return cls(message=message)
+
+class OutboundConnection:
+    def __init__(self, websocket: WebSocket, maxsize: int = 256):
+        self.websocket = websocket
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=maxsize)
+        self.writer = asyncio.create_task(self._drain())
+    def send(self, message: str) -> bool:
+        if self.writer.done():
+            return False
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+    async def _drain(self):
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                if len(batch) == 1:
+                    await self.websocket.send_text(batch[0])
+                else:
+                    await self.websocket.send_text('{"type":"multi","messages":[' + ",".join(batch) + "]}")
+        except Exception as e:
+            logger.error("Error sending to websocket: %s", e)
+    def stop(self):
+        self.writer.cancel()
+    async def close(self, code: int = 1000):
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except Exception as e:
+            logger.error("Error closing websocket: %s", e)
+
 class UserConnectionManager:
     def __init__(self):
-        self.active_connections: dict[str, WebSocket] = {}
+        self.active_connections: dict[str, OutboundConnection] = {}
     async def connect(self, chat_id: str, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections[chat_id] = websocket
+        previous = self.active_connections.get(chat_id)
+        if previous:
+            previous.stop()
+        self.active_connections[chat_id] = OutboundConnection(websocket)
         logger.info("User WS connected for chat_id=%s", chat_id)
-    def disconnect(self, chat_id: str):
-        if chat_id in self.active_connections:
+    def disconnect(self, chat_id: str, websocket: WebSocket):
+        connection = self.active_connections.get(chat_id)
+        if connection and connection.websocket is websocket:
             del self.active_connections[chat_id]
+            connection.stop()
             logger.info("User WS disconnected for chat_id=%s", chat_id)
     async def send_personal_message(self, message: str, chat_id: str):
-        websocket = self.active_connections.get(chat_id)
-        if websocket:
-            await websocket.send_text(message)
+        connection = self.active_connections.get(chat_id)
+        if connection and not connection.send(message):
+            logger.warning("User WS for chat_id=%s is not keeping up, closing it", chat_id)
+            self.disconnect(chat_id, connection.websocket)
+            await connection.close(code=1013)
 
 user_manager = UserConnectionManager()
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, db: AsyncSession = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket):
     chat_id = websocket.query_params.get("chat_id")
     if not chat_id:
         await websocket.close(code=1008)
@@ -118,157 +193,156 @@ async def websocket_endpoint(websocket: WebSocket, db: AsyncSession = Depends(ge
 
     await user_manager.connect(chat_id, websocket)
 
-    async with db.begin():
-        stmt = select(User).where(User.chat_id == chat_id)
-        result = await db.execute(stmt)
-        user = result.scalars().first()
+    async def send_token(delta: str):
+        await user_manager.send_personal_message(orjson.dumps({"type": "token", "delta": delta}).decode(), chat_id)
 
-        if not user:
-            user = User(chat_id=chat_id)
-            db.add(user)
-            await db.flush()
+    async with async_session() as db:
+        async with db.begin():
+            stmt = select(User).where(User.chat_id == chat_id)
+            result = await db.execute(stmt)
+            user = result.scalars().first()
 
-            thread = Thread(user_id=user.id)
-            db.add(thread)
+            if not user:
+                user = User(chat_id=chat_id)
+                db.add(user)
+                await db.flush()
 
-            logger.info("New user created for chat_id=%s", chat_id)
-        else:
-            stmt = (
-                select(Thread)
-                .where(Thread.user_id == user.id)
-                .order_by(Thread.created_at.desc())
-            )
-            result = await db.execute(stmt)
-            thread = result.scalars().first()
-            if not thread:
                 thread = Thread(user_id=user.id)
                 db.add(thread)
 
-            logger.info("Existing user for chat_id=%s, using thread id=%s", chat_id, thread.id)
+                logger.info("New user created for chat_id=%s", chat_id)
+            else:
+                stmt = (
+                    select(Thread)
+                    .where(Thread.user_id == user.id)
+                    .order_by(Thread.created_at.desc())
+                )
+                result = await db.execute(stmt)
+                thread = result.scalars().first()
+                if not thread:
+                    thread = Thread(user_id=user.id)
+                    db.add(thread)
 
-    await db.commit()
+                logger.info("Existing user for chat_id=%s, using thread id=%s", chat_id, thread.id)
 
-    try:
-        while True:
-            data = await websocket.receive_text()
-            payload = json.loads(data)
-            message_text = payload.get("message", "")
-
-            async with db.begin():
-                user_msg = Message(
-                    thread_id=thread.id,
-                    sender="user",
-                    content=message_text
-                )
-                db.add(user_msg)
-            await db.commit()
-
-            broadcast_payload = {
-                "chat_id": chat_id,
-                "type": "message",
-                "message": message_text,
-                "sender": "user"
-            }
-            await manager_manager.broadcast(json.dumps(broadcast_payload))
-            if chat_id not in active_manager_chats:
-                if OPENAI_KEY and ASSISTANT_ID:
-                    try:
-                        async with db.begin():
-                            stmt = select(OpenAIThread).where(OpenAIThread.user_id == user.id)
-                            result = await db.execute(stmt)
-                            openai_thread = result.scalars().first()
-
-                            if not openai_thread:
-                                openai_thread_id = await create_thread(message_text)
-                                openai_thread = OpenAIThread(
-                                    user_id=user.id,
-                                    openai_thread_id=openai_thread_id
-                                )
-                                db.add(openai_thread)
+            stmt = select(OpenAIThread.openai_thread_id).where(OpenAIThread.user_id == user.id)
+            result = await db.execute(stmt)
+            openai_thread_id: Optional[str] = result.scalars().first()
+
+        try:
+            while True:
+                data = await websocket.receive_text()
+                try:
+                    inbound = InboundMessage.parse(data)
+                except ValueError as e:
+                    logger.warning("Ignoring malformed message from chat_id=%s: %s", chat_id, e)
+                    continue
+                message_text = inbound.message
+
+                async with db.begin():
+                    user_msg = Message(
+                        thread_id=thread.id,
+                        sender="user",
+                        content=message_text
+                    )
+                    db.add(user_msg)
+
+                broadcast_payload = {
+                    "chat_id": chat_id,
+                    "type": "message",
+                    "message": message_text,
+                    "sender": "user"
+                }
+                await manager_manager.broadcast(orjson.dumps(broadcast_payload).decode())
+                if chat_id not in active_manager_chats:
+                    if OPENAI_KEY and ASSISTANT_ID:
+                        try:
+                            if openai_thread_id is None:
+                                new_openai_thread_id = await create_thread(message_text)
+                                async with db.begin():
+                                    db.add(OpenAIThread(user_id=user.id, openai_thread_id=new_openai_thread_id))
+                                openai_thread_id = new_openai_thread_id
                                 logger.info("Создан OpenAI Thread с id=%s для user=%s", openai_thread_id, user.id)
                             else:
-                                await add_user_message(openai_thread.openai_thread_id, message_text)
-
-                        await db.commit()
+                                await add_user_message(openai_thread_id, message_text)
 
-                        async with db.begin():
-                            bot_response = await create_run(openai_thread.openai_thread_id)
+                            bot_response = await create_run(openai_thread_id, on_delta=send_token)
                             logger.info(f"OpenAI ответ: {bot_response}")
 
-                            bot_msg = Message(
-                                thread_id=thread.id,
-                                sender="bot",
-                                content=bot_response
-                            )
+                            async with db.begin():
+                                bot_msg = Message(
+                                    thread_id=thread.id,
+                                    sender="bot",
+                                    content=bot_response
+                                )
+                                db.add(bot_msg)
+                        except Exception as e:
+                            logging.info(e)
+                            bot_response = f"Openai error: {e}."
+
+                        response_payload = {
+                            "type": "message",
+                            "message": bot_response,
+                            "sender": "bot"
+                        }
+                        await user_manager.send_personal_message(orjson.dumps(response_payload).decode(), chat_id)
+
+                        broadcast_payload_bot = {
+                            "chat_id": chat_id,
+                            "type": "message",
+                            "message": bot_response,
+                            "sender": "bot"
+                        }
+                        await manager_manager.broadcast(orjson.dumps(broadcast_payload_bot).decode())
+                    else:
+                        await asyncio.sleep(4)
+                        bot_response = f"Bot echo: {message_text}"
+                        async with db.begin():
+                            bot_msg = Message(thread_id=thread.id, sender="bot", content=bot_response)
                             db.add(bot_msg)
-                        await db.commit()
-                    except Exception as e:
-                        logging.info(e)
-                        bot_response = f"Openai error: {e}."
-
-                    response_payload = {
-                        "type": "message",
-                        "message": bot_response,
-                        "sender": "bot"
-                    }
-                    await user_manager.send_personal_message(json.dumps(response_payload), chat_id)
-
-                    broadcast_payload_bot = {
-                        "chat_id": chat_id,
-                        "type": "message",
-                        "message": bot_response,
-                        "sender": "bot"
-                    }
-                    await manager_manager.broadcast(json.dumps(broadcast_payload_bot))
-                else:
-                    await asyncio.sleep(4)
-                    bot_response = f"Bot echo: {message_text}"
-                    async with db.begin():
-                        bot_msg = Message(thread_id=thread.id, sender="bot", content=bot_response)
-                        db.add(bot_msg)
-                    await db.commit()
-
-                    response_payload = {
-                        "type": "message",
-                        "message": bot_response,
-                        "sender": "bot"
-                    }
-                    await user_manager.send_personal_message(json.dumps(response_payload), chat_id)
-
-                    broadcast_payload_bot = {
-                        "chat_id": chat_id,
-                        "type": "message",
-                        "message": bot_response,
-                        "sender": "bot"
-                    }
-                    await manager_manager.broadcast(json.dumps(broadcast_payload_bot))
 
+                        response_payload = {
+                            "type": "message",
+                            "message": bot_response,
+                            "sender": "bot"
+                        }
+                        await user_manager.send_personal_message(orjson.dumps(response_payload).decode(), chat_id)
+
+                        broadcast_payload_bot = {
+                            "chat_id": chat_id,
+                            "type": "message",
+                            "message": bot_response,
+                            "sender": "bot"
+                        }
+                        await manager_manager.broadcast(orjson.dumps(broadcast_payload_bot).decode())
 
 
-    except WebSocketDisconnect:
-        user_manager.disconnect(chat_id)
-    except Exception as e:
-        user_manager.disconnect(chat_id)
-        logger.exception("Unexpected error in user websocket: %s", e)
+
+        except WebSocketDisconnect:
+            user_manager.disconnect(chat_id, websocket)
+        except Exception as e:
+            user_manager.disconnect(chat_id, websocket)
+            logger.exception("Unexpected error in user websocket: %s", e)
 
 
 class ManagerConnectionManager:
     def __init__(self):
-        self.active_connections = []
+        self.active_connections: dict[int, OutboundConnection] = {}
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections[id(websocket)] = OutboundConnection(websocket)
         logger.info("Manager WS connected")
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(id(websocket), None)
+        if connection:
+            connection.stop()
             logger.info("Manager WS disconnected")
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.exception("Error broadcasting to manager: %s", e)
+        dropped = [connection for connection in self.active_connections.values() if not connection.send(message)]
+        for connection in dropped:
+            logger.warning("Manager WS is not keeping up, closing it")
+            self.disconnect(connection.websocket)
+            await connection.close(code=1013)
 
 manager_manager = ManagerConnectionManager()
 
@@ -317,65 +391,72 @@ async def send_manager_message(payload: dict, db: AsyncSession = Depends(get_db)
             raise HTTPException(status_code=404, detail="Thread not found")
         msg = Message(thread_id=thread.id, sender="manager" if action is None else "action", content=message)
         db.add(msg)
-    await db.commit()
     if not action:
         response_payload = {"type": "message", "message": message, "sender": "manager"}
     else:
         response_payload = {"type": "message", "message": message, "sender": "action"}
 
-    await user_manager.send_personal_message(json.dumps(response_payload), chat_id)
-    await manager_manager.broadcast(json.dumps({
+    await user_manager.send_personal_message(orjson.dumps(response_payload).decode(), chat_id)
+    await manager_manager.broadcast(orjson.dumps({
         "chat_id": chat_id,
         "type": "message",
         "message": message,
         "sender": "manager " if action is None else "action"
-    }))
+    }).decode())
     return JSONResponse(content={"status": "ok"})
 
 
+message_json = func.json_build_object(
+    "sender", Message.sender,
+    "text", Message.content,
+    "timestamp", func.to_char(Message.timestamp, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+)
+
 @app.get("/history")
 async def get_chat_history(chat_id: str, db: AsyncSession = Depends(get_db)):
-    stmt = select(User).where(User.chat_id == chat_id)
-    result = await db.execute(stmt)
-    user = result.scalars().first()
-    if not user:
-        return []
-    stmt = select(Thread).where(Thread.user_id == user.id).order_by(Thread.created_at.desc())
-    result = await db.execute(stmt)
-    thread = result.scalars().first()
-    if not thread:
-        return []
-    stmt = select(Message).where(Message.thread_id == thread.id).order_by(Message.timestamp.asc())
+    latest_thread_id = (
+        select(Thread.id)
+        .join(Thread.user)
+        .where(User.chat_id == chat_id)
+        .order_by(Thread.created_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    stmt = (
+        select(func.coalesce(cast(func.json_agg(aggregate_order_by(message_json, Message.timestamp.asc())), Text), "[]"))
+        .where(Message.thread_id == latest_thread_id)
+    )
     result = await db.execute(stmt)
-    messages_list = result.scalars().all()
-    history = [
-        {"sender": msg.sender, "text": msg.content, "timestamp": msg.timestamp.isoformat()}
-        for msg in messages_list
-    ]
-    return history
+    return Response(content=result.scalar(), media_type="application/json")
 
 @app.get("/manager/chats")
 async def get_manager_chats(db: AsyncSession = Depends(get_db)):
-    stmt = select(User)
+    latest_thread = (
+        select(Thread.id, Thread.user_id)
+        .distinct(Thread.user_id)
+        .order_by(Thread.user_id, Thread.created_at.desc())
+        .cte("latest_thread")
+    )
+    thread_messages = (
+        select(
+            Message.thread_id,
+            func.json_agg(aggregate_order_by(message_json, Message.timestamp.asc())).label("messages"),
+            func.max(Message.timestamp).label("last_ts")
+        )
+        .join(latest_thread, latest_thread.c.id == Message.thread_id)
+        .group_by(Message.thread_id)
+        .subquery()
+    )
+    chat_json = func.json_build_object(
+        "id", User.chat_id,
+        "userName", func.right(User.chat_id, 6),
+        "messages", func.coalesce(thread_messages.c.messages, func.json_build_array()),
+    )
+    stmt = (
+        select(func.coalesce(cast(func.json_agg(aggregate_order_by(chat_json, thread_messages.c.last_ts.desc().nulls_last())), Text), "[]"))
+        .select_from(User)
+        .join(latest_thread, latest_thread.c.user_id == User.id)
+        .outerjoin(thread_messages, thread_messages.c.thread_id == latest_thread.c.id)
+    )
     result = await db.execute(stmt)
-    users = result.scalars().all()
-    chats = []
-    for user in users:
-        stmt = select(Thread).where(Thread.user_id == user.id).order_by(Thread.created_at.desc())
-        result = await db.execute(stmt)
-        thread = result.scalars().first()
-        if thread:
-            stmt = select(Message).where(Message.thread_id == thread.id).order_by(Message.timestamp.asc())
-            result = await db.execute(stmt)
-            messages_list = result.scalars().all()
-            history = [
-                {"sender": msg.sender, "text": msg.content, "timestamp": msg.timestamp.isoformat()}
-                for msg in messages_list
-            ]
-            chats.append({
-                "id": user.chat_id,
-                "userName": user.chat_id[-6:],
-                "messages": history
-            })
-    chats.sort(key=lambda chat: chat["messages"][-1]["timestamp"] if chat["messages"] else "", reverse=True)
-    return chats
+    return Response(content=result.scalar(), media_type="application/json")